@@ -19,6 +19,8 @@ __copyright__ = '(c) 2020 Red Hat Inc.'
 __license__ = 'LGPL 3+'
 
 import sys
+import collections
+import functools
 from gi.repository import GLib
 import dbus
 import asyncio
@@ -36,7 +38,38 @@ MANAGER_MOCK_IFACE = 'net.reactivated.Fprint.Manager.Mock'
 DEVICE_IFACE = 'net.reactivated.Fprint.Device'
 DEVICE_MOCK_IFACE = 'net.reactivated.Fprint.Device.Mock'
 
-VALID_FINGER_NAMES = [
+# (result, done) as used by VerifyStatus and EnrollStatus
+STATUS_SIGNATURE = 'sb'
+
+ERROR_ALREADY_IN_USE = 'net.reactivated.Fprint.Error.AlreadyInUse'
+ERROR_CLAIM_DEVICE = 'net.reactivated.Fprint.Error.ClaimDevice'
+ERROR_INVALID_FINGERNAME = 'net.reactivated.Fprint.Error.InvalidFingername'
+ERROR_NO_ACTION_IN_PROGRESS = 'net.reactivated.Fprint.Error.NoActionInProgress'
+ERROR_NO_ENROLLED_PRINTS = 'net.reactivated.Fprint.Error.NoEnrolledPrints'
+ERROR_NO_SUCH_DEVICE = 'net.reactivated.Fprint.Error.NoSuchDevice'
+ERROR_INTERNAL = 'org.freedesktop.DBus.Error.Internal'
+ERROR_INVALID_ARGS = 'org.freedesktop.DBus.Error.InvalidArgs'
+
+# Errors with a fixed message, as (message, name) to be raised through
+# raise_error()
+NOT_CLAIMED_ERROR = ('Device was not claimed before use',
+    ERROR_CLAIM_DEVICE)
+NOT_VERIFYING_ERROR = ('Cannot send verify statuses when not verifying',
+    ERROR_INVALID_ARGS)
+NOT_ENROLLING_ERROR = ('Cannot send enroll statuses when not enrolling',
+    ERROR_INVALID_ARGS)
+NO_VERIFICATION_TO_STOP_ERROR = ('No verification to stop',
+    ERROR_NO_ACTION_IN_PROGRESS)
+NO_ENROLLMENT_TO_STOP_ERROR = ('No enrollment to stop',
+    ERROR_NO_ACTION_IN_PROGRESS)
+EMPTY_PATH_ERROR = ('Invalid empty path.',
+    ERROR_INVALID_ARGS)
+EMPTY_FINGER_NAME_ERROR = ('Invalid empty finger_name.',
+    ERROR_INVALID_ARGS)
+NOT_VERIFYING_DEVICE_ERROR = ('Device is not verifying',
+    ERROR_NO_ACTION_IN_PROGRESS)
+
+VALID_FINGER_NAMES = frozenset({
     'left-thumb',
     'left-index-finger',
     'left-middle-finger',
@@ -47,9 +80,9 @@ VALID_FINGER_NAMES = [
     'right-middle-finger',
     'right-ring-finger',
     'right-little-finger'
-]
+})
 
-VALID_VERIFY_STATUS = [
+VALID_VERIFY_STATUS = frozenset({
     'verify-no-match',
     'verify-match',
     'verify-retry-scan',
@@ -58,9 +91,9 @@ VALID_VERIFY_STATUS = [
     'verify-remove-and-retry',
     'verify-disconnected',
     'verify-unknown-error'
-]
+})
 
-VALID_ENROLL_STATUS = [
+VALID_ENROLL_STATUS = frozenset({
     'enroll-completed',
     'enroll-failed',
     'enroll-stage-passed',
@@ -71,18 +104,37 @@ VALID_ENROLL_STATUS = [
     'enroll-data-full',
     'enroll-disconnected',
     'enroll-unknown-error'
-]
+})
+
+def raise_error(error):
+    message, name = error
+    raise dbus.exceptions.DBusException(message, name=name)
+
+def require_claimed(device):
+    if not device.claimed_user:
+        raise_error(NOT_CLAIMED_ERROR)
+
+def require_no_action(device):
+    if device.action:
+        raise dbus.exceptions.DBusException(
+            f"Action '{device.action}' already in progress",
+            name=ERROR_ALREADY_IN_USE)
+
+def require_action(device, action, error):
+    if device.action != action:
+        raise_error(error)
 
 def load(mock, parameters):
-    fprintd = mockobject.objects[MAIN_OBJ]
     mock.last_device_id = 0
-    fprintd.fingers = {}
+    # Insertion-ordered, so the default device is the first one added
+    mock.device_paths = {}
+    mock.fingers = {}
     mock.loop = asyncio.new_event_loop()
 
 @dbus.service.method(MAIN_IFACE,
                      in_signature='', out_signature='ao')
 def GetDevices(self):
-    return [(k) for k in mockobject.objects.keys() if "/Device/" in k]
+    return dbus.Array(self.device_paths, signature='o')
 
 @dbus.service.method(MAIN_IFACE,
                      in_signature='', out_signature='o')
@@ -91,7 +143,7 @@ def GetDefaultDevice(self):
     if len(devices) < 1:
         raise dbus.exceptions.DBusException(
             'No devices available',
-            name='net.reactivated.Fprint.Error.NoSuchDevice')
+            name=ERROR_NO_SUCH_DEVICE)
     return devices[0]
 
 @dbus.service.method(MANAGER_MOCK_IFACE,
@@ -107,16 +159,16 @@ def AddDevice(self, device_name, num_enroll_stages, scan_type,
 
     if scan_type not in ['swipe', 'press']:
         raise dbus.exceptions.DBusException(
-            'Invalid scan_type \'%s\'.' % scan_type,
-            name='org.freedesktop.DBus.Error.InvalidArgs')
+            f"Invalid scan_type '{scan_type}'.",
+            name=ERROR_INVALID_ARGS)
 
     if num_enroll_stages <= 0:
         raise dbus.exceptions.DBusException(
-            'Invalid num_enroll_stages \'%s\'.' % num_enroll_stages,
-            name='org.freedesktop.DBus.Error.InvalidArgs')
+            f"Invalid num_enroll_stages '{num_enroll_stages}'.",
+            name=ERROR_INVALID_ARGS)
 
     self.last_device_id += 1
-    path = '/net/reactivated/Fprint/Device/%d' % self.last_device_id
+    path = f'/net/reactivated/Fprint/Device/{self.last_device_id}'
     device_properties = {
         'name': dbus.String(device_name, variant_level=1),
         'num-enroll-stages': dbus.Int32(num_enroll_stages, variant_level=1),
@@ -128,14 +180,24 @@ def AddDevice(self, device_name, num_enroll_stages, scan_type,
                    # Properties
                    device_properties,
                    [])
+    self.device_paths[path] = None
 
     device = mockobject.objects[path]
     device.fingers = {}
+    device.finger_sets = {}
     device.has_identification = has_identification
     device.claimed_user = None
     device.action = None
     device.selected_finger = None
-    device.verify_script = []
+    device.last_valid_finger = None
+    device.verify_script = ()
+    device.verify_script_pos = 0
+    # Pending verify script sources, by schedule
+    device.schedule_sources = {}
+    device.emit_verify_status = functools.partial(device.EmitSignal,
+        DEVICE_IFACE, 'VerifyStatus', STATUS_SIGNATURE)
+    device.emit_enroll_status = functools.partial(device.EmitSignal,
+        DEVICE_IFACE, 'EnrollStatus', STATUS_SIGNATURE)
 
     return path
 
@@ -146,224 +208,227 @@ def RemoveDevice(self, path):
     # support yet, but it's meant to remove devices added to the mock for
     # testing purposes.
     if not path:
-        raise dbus.exceptions.DBusException(
-            'Invalid empty path.',
-            name='org.freedesktop.DBus.Error.InvalidArgs')
+        raise_error(EMPTY_PATH_ERROR)
 
+    if path in mockobject.objects:
+        device_cancel_schedules(mockobject.objects[path])
     self.RemoveObject(path)
+    self.device_paths.pop(path, None)
+
+@dbus.service.method(MANAGER_MOCK_IFACE,
+                     in_signature='', out_signature='')
+def Reset(self):
+    '''Convenience method to remove all the devices
+
+    This brings the mock back to its initial state, so that it can be
+    reused across tests.
+    '''
+
+    for path in self.device_paths:
+        device_cancel_schedules(mockobject.objects[path])
+        self.RemoveObject(path)
+    self.device_paths.clear()
+    self.last_device_id = 0
+    self.fingers = {}
 
 @dbus.service.method(DEVICE_IFACE,
                      in_signature='s', out_signature='as')
 def ListEnrolledFingers(device, user):
     if user in device.fingers:
-        return device.fingers[user]
+        return dbus.Array(device.fingers[user], signature='s')
     raise dbus.exceptions.DBusException(
-        'No enrolled prints in device %s for user %s' % (device.path, user),
-        name='net.reactivated.Fprint.Error.NoEnrolledPrints')
+        f'No enrolled prints in device {device.path} for user {user}',
+        name=ERROR_NO_ENROLLED_PRINTS)
 
 @dbus.service.method(DEVICE_IFACE,
                      in_signature='s', out_signature='')
 def DeleteEnrolledFingers(device, user):
     device.fingers[user] = []
+    device.finger_sets[user] = set()
 
 @dbus.service.method(DEVICE_IFACE,
                      in_signature='', out_signature='')
 def DeleteEnrolledFingers2(device):
-    if not device.claimed_user:
-        raise dbus.exceptions.DBusException(
-            'Device was not claimed before use',
-            name='net.reactivated.Fprint.Error.ClaimDevice')
+    require_claimed(device)
     if not device.fingers[device.claimed_user]:
         raise dbus.exceptions.DBusException(
-            'No enrolled prints in device {} for user {}'.format(device.path,
-                device.claimed_user),
-            name='net.reactivated.Fprint.Error.NoEnrolledPrints')
+            f'No enrolled prints in device {device.path} for user {device.claimed_user}',
+            name=ERROR_NO_ENROLLED_PRINTS)
     device.fingers[device.claimed_user] = []
+    device.finger_sets[device.claimed_user] = set()
 
 @dbus.service.method(DEVICE_IFACE,
                      in_signature='s', out_signature='')
 def Claim(device, user):
     if device.claimed_user:
         raise dbus.exceptions.DBusException(
-            'Device already in use by %s' % device.claimed_user,
-            name='net.reactivated.Fprint.Error.AlreadyInUse')
+            f'Device already in use by {device.claimed_user}',
+            name=ERROR_ALREADY_IN_USE)
 
     device.claimed_user = user
 
 @dbus.service.method(DEVICE_IFACE,
                      in_signature='', out_signature='')
 def Release(device):
-    if not device.claimed_user:
-        raise dbus.exceptions.DBusException(
-            'Device was not claimed before use',
-            name='net.reactivated.Fprint.Error.ClaimDevice')
+    require_claimed(device)
     device.claimed_user = None
     device.action = None
     device.selected_finger = None
 
-def can_verify_finger(device, finger_name):
+def can_verify_finger(device, user, finger_name):
     # We should already have checked that there are enrolled fingers
     if finger_name == 'any':
         return True
-    if finger_name in device.fingers[device.claimed_user]:
-        return True
-    return False
+    return finger_name in device.finger_sets[user]
 
 def glib_sleep(timeout):
-    waiting = True
+    loop = GLib.MainLoop()
 
     def done_waiting():
-        nonlocal waiting
-        waiting = False
+        loop.quit()
+        return GLib.SOURCE_REMOVE
 
     GLib.timeout_add(timeout, done_waiting)
-    while (waiting):
-        GLib.main_context_default().iteration(True)
+    loop.run()
 
 def device_run_script(device, result, done):
     if result == 'MOCK: quit':
         sys.exit(0)
 
     # Emit signal
-    device.EmitSignal(DEVICE_IFACE, 'VerifyStatus', 'sb', [
-                        result,
-                        done
-                      ])
+    device.emit_verify_status([result, done])
+
+def device_run_schedule(device, schedule):
+    _, func, args = schedule.popleft()
+    func(*args)
+
+    # Re-arm for the next step, its delay is relative to this one
+    if schedule:
+        device.schedule_sources[id(schedule)] = GLib.timeout_add(
+            schedule[0][0], device_run_schedule, device, schedule)
+    else:
+        del device.schedule_sources[id(schedule)]
+
+    return GLib.SOURCE_REMOVE
+
+def device_cancel_schedules(device):
+    # Steps left over must not fire on a device added later on the same path
+    for source in device.schedule_sources.values():
+        GLib.source_remove(source)
+    device.schedule_sources.clear()
 
 @dbus.service.method(DEVICE_IFACE,
                      in_signature='s', out_signature='')
 def VerifyStart(device, finger_name):
-    if not device.claimed_user:
-        raise dbus.exceptions.DBusException(
-            'Device was not claimed before use',
-            name='net.reactivated.Fprint.Error.ClaimDevice')
-    if device.claimed_user not in device.fingers:
+    require_claimed(device)
+    claimed_user = device.claimed_user
+    enrolled = device.fingers.get(claimed_user)
+    if enrolled is None:
         raise dbus.exceptions.DBusException(
-            'No enrolled prints for user \'%s\'' % device.claimed_user,
-            name='net.reactivated.Fprint.Error.NoEnrolledPrints')
+            f"No enrolled prints for user '{claimed_user}'",
+            name=ERROR_NO_ENROLLED_PRINTS)
     if not finger_name:
+        raise_error(EMPTY_FINGER_NAME_ERROR)
+    if not can_verify_finger(device, claimed_user, finger_name):
         raise dbus.exceptions.DBusException(
-            'Invalid empty finger_name.',
-            name='org.freedesktop.DBus.Error.InvalidArgs')
-    if not can_verify_finger(device, finger_name):
-        raise dbus.exceptions.DBusException(
-            'Finger \'%s\' not enrolled.' % finger_name,
-            name='org.freedesktop.DBus.Error.Internal')
-    if device.action:
-        raise dbus.exceptions.DBusException(
-            'Action \'%s\' already in progress' % device.action,
-            name='net.reactivated.Fprint.Error.AlreadyInUse')
+            f"Finger '{finger_name}' not enrolled.",
+            name=ERROR_INTERNAL)
+    require_no_action(device)
     device.action = 'verify'
 
     if finger_name == 'any' and not device.has_identification:
-        finger_name = device.fingers[device.claimed_user][0]
+        finger_name = enrolled[0]
     device.selected_finger = finger_name
-    # Needs to happen after method return
-    GLib.idle_add(device.EmitSignal,
-                  DEVICE_IFACE, 'VerifyFingerSelected', 's', [
-                    device.selected_finger
-                  ])
 
     error = None
-    base_delay = 0
-    while device.verify_script is not None and len(device.verify_script) > 0:
-        result, done, timeout = device.verify_script.pop(0)
+    # Needs to happen after method return
+    schedule = collections.deque([
+        (0, device.EmitSignal, (DEVICE_IFACE, 'VerifyFingerSelected', 's', [
+            device.selected_finger
+        ]))
+    ])
+    script = device.verify_script
+    while device.verify_script_pos < len(script):
+        result, done, timeout = script[device.verify_script_pos]
+        device.verify_script_pos += 1
 
         # We stop when "timeout >= 0 and done"
         if result == 'MOCK: no-prints':
             # Special case to change return value of DBus call, ignores timeout
             error = dbus.exceptions.DBusException(
-                'No enrolled prints for user \'%s\'' % device.claimed_user,
-                name='net.reactivated.Fprint.Error.NoEnrolledPrints')
+                f"No enrolled prints for user '{claimed_user}'",
+                name=ERROR_NO_ENROLLED_PRINTS)
 
         elif timeout < 0:
-            # Negative timeouts mean emitting before the DBus call returns
+            # Negative timeouts mean emitting before the DBus call returns.
+            # This has to stay in the method handler so that the signal is
+            # queued ahead of the reply; glib_sleep() runs a nested main loop
+            # so other calls are still dispatched while waiting.
             device_run_script(device, result, done)
             glib_sleep(-timeout)
 
         else:
             # Positive or zero means emitting afterwards the given timeout
-            base_delay += timeout
-            GLib.timeout_add(base_delay,
-                             device_run_script,
-                             device,
-                             result,
-                             done)
+            schedule.append((timeout, device_run_script, (device, result, done)))
 
             # Stop processing commands when the done flag is set
             if done:
                 break
 
+    # A single source walks through the whole schedule
+    if schedule:
+        device.schedule_sources[id(schedule)] = GLib.timeout_add(0,
+            device_run_schedule, device, schedule)
+
     if error:
         raise error
 
 @dbus.service.method(DEVICE_MOCK_IFACE,
-                     in_signature='sb', out_signature='')
+                     in_signature=STATUS_SIGNATURE, out_signature='')
 def EmitVerifyStatus(device, result, done):
-    if (not device.action) or (device.action != 'verify'):
-        raise dbus.exceptions.DBusException(
-            'Cannot send verify statuses when not verifying',
-            name='org.freedesktop.DBus.Error.InvalidArgs')
+    require_action(device, 'verify', NOT_VERIFYING_ERROR)
     if result not in VALID_VERIFY_STATUS:
         raise dbus.exceptions.DBusException(
-            'Unknown verify status \'%s\'' % result,
-            name='org.freedesktop.DBus.Error.InvalidArgs')
-    device.EmitSignal(DEVICE_IFACE, 'VerifyStatus', 'sb', [
-                          result,
-                          done
-                      ])
+            f"Unknown verify status '{result}'",
+            name=ERROR_INVALID_ARGS)
+    device.emit_verify_status([result, done])
 
 @dbus.service.method(DEVICE_IFACE,
                      in_signature='', out_signature='')
 def VerifyStop(device):
-    if device.action != 'verify':
-        raise dbus.exceptions.DBusException(
-            'No verification to stop',
-            name='net.reactivated.Fprint.Error.NoActionInProgress')
+    require_action(device, 'verify', NO_VERIFICATION_TO_STOP_ERROR)
     device.action = None
     device.selected_finger = None
 
 @dbus.service.method(DEVICE_IFACE,
                      in_signature='s', out_signature='')
 def EnrollStart(device, finger_name):
-    if finger_name not in VALID_FINGER_NAMES:
-        raise dbus.exceptions.DBusException(
-            'Invalid finger name \'%s\'' % finger_name,
-            name='net.reactivated.Fprint.Error.InvalidFingername')
-    if not device.claimed_user:
-        raise dbus.exceptions.DBusException(
-            'Device was not claimed before use',
-            name='net.reactivated.Fprint.Error.ClaimDevice')
-    if device.action:
-        raise dbus.exceptions.DBusException(
-            'Action \'%s\' already in progress' % device.action,
-            name='net.reactivated.Fprint.Error.AlreadyInUse')
+    # Tests tend to enroll the same finger over and over
+    if finger_name != device.last_valid_finger:
+        if finger_name not in VALID_FINGER_NAMES:
+            raise dbus.exceptions.DBusException(
+                f"Invalid finger name '{finger_name}'",
+                name=ERROR_INVALID_FINGERNAME)
+        device.last_valid_finger = finger_name
+    require_claimed(device)
+    require_no_action(device)
     device.action = 'enroll'
 
 @dbus.service.method(DEVICE_MOCK_IFACE,
-                     in_signature='sb', out_signature='')
+                     in_signature=STATUS_SIGNATURE, out_signature='')
 def EmitEnrollStatus(device, result, done):
-    if (not device.action) or (device.action != 'enroll'):
-        raise dbus.exceptions.DBusException(
-            'Cannot send enroll statuses when not enrolling',
-            name='org.freedesktop.DBus.Error.InvalidArgs')
+    require_action(device, 'enroll', NOT_ENROLLING_ERROR)
     if result not in VALID_ENROLL_STATUS:
         raise dbus.exceptions.DBusException(
-            'Unknown enroll status \'%s\'' % result,
-            name='org.freedesktop.DBus.Error.InvalidArgs')
-    device.EmitSignal(DEVICE_IFACE, 'EnrollStatus', 'sb', [
-                          result,
-                          done
-                      ])
+            f"Unknown enroll status '{result}'",
+            name=ERROR_INVALID_ARGS)
+    device.emit_enroll_status([result, done])
     # FIXME save enrolled finger?
 
 @dbus.service.method(DEVICE_IFACE,
                      in_signature='', out_signature='')
 def EnrollStop(device):
-    if device.action != 'enroll':
-        raise dbus.exceptions.DBusException(
-            'No enrollment to stop',
-            name='net.reactivated.Fprint.Error.NoActionInProgress')
+    require_action(device, 'enroll', NO_ENROLLMENT_TO_STOP_ERROR)
     device.action = None
 
 @dbus.service.method(DEVICE_MOCK_IFACE,
@@ -377,13 +442,16 @@ def SetEnrolledFingers(device, user, fingers):
     Returns nothing.
     '''
 
-    for k in fingers:
-        if k not in VALID_FINGER_NAMES:
-            raise dbus.exceptions.DBusException(
-                'Invalid finger name \'%s\'' % k,
-                name='org.freedesktop.DBus.Error.InvalidArgs')
+    finger_set = set(fingers)
+    invalid = finger_set - VALID_FINGER_NAMES
+    if invalid:
+        k = next(k for k in fingers if k in invalid)
+        raise dbus.exceptions.DBusException(
+            f"Invalid finger name '{k}'",
+            name=ERROR_INVALID_ARGS)
 
-    device.fingers[user] = fingers
+    device.fingers[user] = list(fingers)
+    device.finger_sets[user] = finger_set
 
 @dbus.service.method(DEVICE_MOCK_IFACE,
                      in_signature='', out_signature='s')
@@ -393,9 +461,7 @@ def GetSelectedFinger(device):
     Returns the finger name that the user has selected for verifying
     '''
     if not device.selected_finger:
-        raise dbus.exceptions.DBusException(
-            'Device is not verifying',
-            name='net.reactivated.Fprint.Error.NoActionInProgress')
+        raise_error(NOT_VERIFYING_DEVICE_ERROR)
 
     return device.selected_finger
 
@@ -422,7 +488,10 @@ def SetVerifyScript(device, script):
     Returns nothing.
     '''
 
-    device.verify_script = script
+    device.verify_script = tuple(
+        (str(result), bool(done), int(timeout))
+        for result, done, timeout in script)
+    device.verify_script_pos = 0
 
 @dbus.service.method(DEVICE_MOCK_IFACE,
                      in_signature='s', out_signature='')
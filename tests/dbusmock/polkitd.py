@@ -99,3 +99,14 @@ def SetAllowed(self, actions):
     '''Set allowed actions'''
 
     self.allowed = actions
+
+@dbus.service.method(MOCK_IFACE, in_signature='', out_signature='')
+def Reset(self):
+    '''Reset the mock to its initial state'''
+
+    self.allow_unknown = False
+    self.allowed = []
+    self.delay = 0
+    self.simulate_hang = False
+    self.hanging_actions = []
+    self.hanging_calls = []
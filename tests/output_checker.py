@@ -19,22 +19,22 @@
 import os
 import sys
 import fcntl
-import io
 import re
 import time
 import threading
 import select
 import errno
+import collections
 
 class OutputChecker(object):
 
     def __init__(self, out=sys.stdout):
         self._output = out
         self._pipe_fd_r, self._pipe_fd_w = os.pipe()
-        self._partial_buf = b''
+        # Grown in place, a line may span over many reads
+        self._partial_buf = bytearray()
         self._lines_sem = threading.Semaphore()
-        self._lines = []
-        self._reader_io = io.StringIO()
+        self._lines = collections.deque()
 
         # Just to be sure, shouldn't be a problem even if we didn't set it
         fcntl.fcntl(self._pipe_fd_r, fcntl.F_SETFL,
@@ -54,10 +54,17 @@ class OutputChecker(object):
                 # Be lazy and wake up occasionally in case _pipe_fd_r became invalid
                 # The reason to do this is because os.read() will *not* return if the
                 # FD is forcefully closed.
-                p.poll(0.1)
+                # Note that the poll() timeout is in milliseconds, and that
+                # there is no point in trying to read if nothing arrived.
+                if not p.poll(100):
+                    continue
 
-                r = os.read(self._pipe_fd_r, 1024)
+                r = os.read(self._pipe_fd_r, 65536)
                 if not r:
+                    # EOF, the last line may not be newline terminated
+                    if self._partial_buf:
+                        self._lines.append(bytes(self._partial_buf))
+                        self._partial_buf = bytearray()
                     os.close(self._pipe_fd_r)
                     self._pipe_fd_r = -1
                     self._lines_sem.release()
@@ -74,66 +81,66 @@ class OutputChecker(object):
                 return
 
             l = r.split(b'\n')
-            l[0] = self._partial_buf + l[0]
-            self._lines.extend(l[:-1])
-            self._partial_buf = l[-1]
+            if len(l) > 1:
+                self._partial_buf += l[0]
+                l[0] = bytes(self._partial_buf)
+                self._lines.extend(l[:-1])
+                self._partial_buf = bytearray(l[-1])
+            else:
+                self._partial_buf += r
 
             self._lines_sem.release()
 
             os.write(self._output.fileno(), r)
 
-    def check_line_re(self, needle_re, timeout=0, failmsg=None):
+    def _check_line(self, match, needle, timeout, failmsg):
         deadline = time.time() + timeout
-
-        if isinstance(needle_re, str):
-            needle_re = needle_re.encode('ascii')
-
-        r = re.compile(needle_re)
         ret = []
 
         while True:
             try:
-                l = self._lines.pop(0)
+                l = self._lines.popleft()
             except IndexError:
                 # EOF, throw error
                 if self._pipe_fd_r == -1:
                     if failmsg:
                         raise AssertionError("No further messages: " % failmsg)
                     else:
-                        raise AssertionError('No client waiting for needle %s' % (str(needle_re)))
+                        raise AssertionError('No client waiting for needle %s' % (str(needle)))
 
                 # Check if should wake up
                 if not self._lines_sem.acquire(timeout = deadline - time.time()):
                     if failmsg:
                         raise AssertionError(failmsg)
                     else:
-                        raise AssertionError('Timed out waiting for needle %s (timeout: %0.2f)' % (str(needle_re), timeout))
+                        raise AssertionError('Timed out waiting for needle %s (timeout: %0.2f)' % (str(needle), timeout))
                 continue
 
             ret.append(l)
-            if r.search(l):
+            if match(l):
                 return ret
 
+    def check_line_re(self, needle_re, timeout=0, failmsg=None):
+        if isinstance(needle_re, str):
+            needle_re = needle_re.encode('ascii')
+
+        return self._check_line(re.compile(needle_re).search, needle_re,
+                                timeout, failmsg)
+
     def check_line(self, needle, timeout=0, failmsg=None):
         if isinstance(needle, str):
             needle = needle.encode('ascii')
 
-        needle_re = re.escape(needle)
-
-        return self.check_line_re(needle_re, timeout=timeout, failmsg=failmsg)
+        # A plain substring search, no need to go through a regex
+        return self._check_line(lambda l: needle in l, needle, timeout, failmsg)
 
-    def check_no_line_re(self, needle_re, wait=0, failmsg=None):
+    def _check_no_line(self, match, needle, wait, failmsg):
         deadline = time.time() + wait
-
-        if isinstance(needle_re, str):
-            needle_re = needle_re.encode('ascii')
-
-        r = re.compile(needle_re)
         ret = []
 
         while True:
             try:
-                l = self._lines.pop(0)
+                l = self._lines.popleft()
             except IndexError:
                 # EOF, so everything good
                 if self._pipe_fd_r == -1:
@@ -146,25 +153,30 @@ class OutputChecker(object):
                 continue
 
             ret.append(l)
-            if r.search(l):
+            if match(l):
                 if failmsg:
                     raise AssertionError(failmsg)
                 else:
-                    raise AssertionError('Found needle %s but shouldn\'t have been there (timeout: %0.2f)' % (str(needle_re), wait))
+                    raise AssertionError('Found needle %s but shouldn\'t have been there (timeout: %0.2f)' % (str(needle), wait))
 
         return ret
 
+    def check_no_line_re(self, needle_re, wait=0, failmsg=None):
+        if isinstance(needle_re, str):
+            needle_re = needle_re.encode('ascii')
+
+        return self._check_no_line(re.compile(needle_re).search, needle_re,
+                                   wait, failmsg)
+
     def check_no_line(self, needle, wait=0, failmsg=None):
         if isinstance(needle, str):
             needle = needle.encode('ascii')
 
-        needle_re = re.escape(needle)
-
-        return self.check_no_line_re(needle_re, wait=wait, failmsg=failmsg)
+        return self._check_no_line(lambda l: needle in l, needle, wait, failmsg)
 
     def clear(self):
-        ret = self._lines
-        self._lines = []
+        # Hand over the queued lines rather than copying them
+        ret, self._lines = self._lines, collections.deque()
         return ret
 
     def assert_closed(self, timeout=1):
@@ -65,21 +65,39 @@ class TestPamFprintd(dbusmock.DBusTestCase):
         klass.template_name = template_path + 'dbusmock/fprintd.py'
         print ('Using template from %s' % klass.template_name)
 
+        klass.p_mock = None
+
+    @classmethod
+    def start_mock(klass):
+        (klass.p_mock, klass.obj_fprintd_manager) = klass.spawn_server_template(
+            klass.template_name, {})
+        klass.obj_fprintd_mock = dbus.Interface(klass.obj_fprintd_manager, 'net.reactivated.Fprint.Manager.Mock')
+
+    @classmethod
+    def stop_mock(klass):
+        if klass.p_mock is None:
+            return
+
+        klass.p_mock.terminate()
+        klass.p_mock.wait()
+        klass.p_mock = None
+
     @classmethod
     def tearDownClass(klass):
+        klass.stop_mock()
         klass.stop_monitor()
 
-        # Remove pam wrapper files, as they may break other tests
-        [shutil.rmtree(i) for i in glob.glob('/tmp/pam.[0-9A-z]')]
+        # Remove pam wrapper files, as they may break other tests. The range
+        # is wide on purpose, pam_wrapper picks the last character itself.
+        for d in glob.iglob('/tmp/pam.[0-9A-Za-z]'):
+            shutil.rmtree(d)
 
     def setUp(self):
-        (self.p_mock, self.obj_fprintd_manager) = self.spawn_server_template(
-            self.template_name, {})
-        self.obj_fprintd_mock = dbus.Interface(self.obj_fprintd_manager, 'net.reactivated.Fprint.Manager.Mock')
-
-    def tearDown(self):
-        self.p_mock.terminate()
-        self.p_mock.wait()
+        # The mock is shared by the class, unless a test made it quit
+        if self.p_mock is None or self.p_mock.poll() is not None:
+            self.start_mock()
+        else:
+            self.obj_fprintd_mock.Reset()
 
     def setup_device(self):
         device_path = self.obj_fprintd_mock.AddDevice('FDO Trigger Finger Laser Reader', 3, 'swipe')
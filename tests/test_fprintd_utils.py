@@ -19,6 +19,8 @@ import dbus
 import dbus.mainloop.glib
 import dbusmock
 import os
+import select
+import shutil
 import time
 from output_checker import OutputChecker
 
@@ -36,6 +38,12 @@ VALID_FINGER_NAMES = [
     'right-little-finger'
 ]
 
+# Final line printed by fprintd-verify, by match result
+VERIFY_RESULT_LINES = {
+    True: b'Verify result: verify-match (done)',
+    False: b'Verify result: verify-no-match (done)',
+}
+
 dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
 class TestFprintdUtilsBase(dbusmock.DBusTestCase):
@@ -45,6 +53,8 @@ class TestFprintdUtilsBase(dbusmock.DBusTestCase):
     def setUpClass(klass):
         klass.start_system_bus()
         klass.dbus_con = klass.get_dbus(True)
+        # Mostly used as the upper bound of the waits for the utilities
+        # output, so scaling it for slower runs costs nothing when passing
         klass.sleep_time = 0.5
 
         template_path = './'
@@ -74,34 +84,52 @@ class TestFprintdUtilsBase(dbusmock.DBusTestCase):
         if 'ADDRESS_SANITIZER' in os.environ:
             klass.sleep_time *= 2
 
+        # Resolve the executables once, rather than on every spawn
+        if klass.wrapper_args:
+            klass.wrapper_args[0] = shutil.which(klass.wrapper_args[0]) or klass.wrapper_args[0]
+        klass.tool_paths = {}
+        for name in ['enroll', 'list', 'delete', 'verify']:
+            path = os.path.join(klass.tools_prefix, 'fprintd-{}'.format(name))
+            klass.tool_paths[name] = shutil.which(path) or path
+
+        # The mock is shared by the tests of the class, and reset by each
+        (klass.p_mock, klass.obj_fprintd_manager) = klass.spawn_server_template(
+            klass.template_name, {})
+        klass.obj_fprintd_mock = dbus.Interface(klass.obj_fprintd_manager, 'net.reactivated.Fprint.Manager.Mock')
+
+    @classmethod
+    def tearDownClass(klass):
+        klass.p_mock.terminate()
+        klass.p_mock.wait()
+        super().tearDownClass()
+
     def setUp(self):
         super().setUp()
-        (self.p_mock, self.obj_fprintd_manager) = self.spawn_server_template(
-            self.template_name, {})
-        # set log to nonblocking
-        self.obj_fprintd_mock = dbus.Interface(self.obj_fprintd_manager, 'net.reactivated.Fprint.Manager.Mock')
-
-    def tearDown(self):
-        self.p_mock.terminate()
-        self.p_mock.wait()
-        super().tearDown()
+        self.obj_fprintd_mock.Reset()
 
     def setup_device(self):
         self.device_path = self.obj_fprintd_mock.AddDevice(
             'FDO Trigger Finger Laser Reader', 3, 'swipe')
-        self.device_mock = self.dbus_con.get_object('net.reactivated.Fprint',
-            self.device_path)
+        self.set_device_mock(self.device_path)
         self.set_enrolled_fingers(['left-little-finger', 'right-little-finger'])
 
+    def set_device_mock(self, path):
+        # The mock methods are called with the types they expect, there is
+        # no need for an Introspect round trip on every new device
+        self.device_mock = self.dbus_con.get_object('net.reactivated.Fprint',
+            path, introspect=False)
+        # Called by every verify test, bind it once
+        self.emit_verify_status = self.device_mock.EmitVerifyStatus
+
     def set_enrolled_fingers(self, fingers, user='toto'):
         self.enrolled_fingers = fingers
         self.device_mock.SetEnrolledFingers('toto', self.enrolled_fingers,
             signature='sas')
 
     def start_utility_process(self, utility_name, args=[], sleep=True):
-        utility = [ os.path.join(self.tools_prefix, 'fprintd-{}'.format(utility_name)) ]
+        argv = self.wrapper_args + [self.tool_paths[utility_name]] + args
         output = OutputChecker()
-        process = subprocess.Popen(self.wrapper_args + utility + args,
+        process = subprocess.Popen(argv,
                                    stdout=output.fd,
                                    stderr=subprocess.STDOUT)
         output.writer_attached()
@@ -124,10 +152,33 @@ class TestFprintdUtilsBase(dbusmock.DBusTestCase):
         except:
             pass
 
-    def run_utility_process(self, utility_name, args=[], sleep=True, timeout=None):
+    def wait_utility_process(self, process, timeout):
+        # Popen.wait() polls the process when given a timeout, get woken up
+        # by the kernel when it exits instead
+        if process.returncode is None and hasattr(os, 'pidfd_open'):
+            try:
+                pidfd = os.pidfd_open(process.pid)
+            except OSError:
+                pass
+            else:
+                try:
+                    poller = select.poll()
+                    poller.register(pidfd, select.POLLIN)
+                    poller.poll(timeout * 1000)
+                finally:
+                    os.close(pidfd)
+                return process.wait(timeout=0)
+
+        return process.wait(timeout=timeout)
+
+    def run_utility_process(self, utility_name, args=[], sleep=False, timeout=None):
+        # No need to wait before waiting for the process to terminate
         proc, output = self.start_utility_process(utility_name, args=args, sleep=sleep)
-        ret = proc.wait(timeout=timeout if timeout is not None else self.sleep_time * 4)
+        ret = self.wait_utility_process(proc,
+            timeout if timeout is not None else self.sleep_time * 4)
         self.assertLessEqual(ret, 128)
+        # Without a sleep the reader may not have drained the pipe yet
+        output.assert_closed()
 
         return b''.join(output.clear()), ret
 
@@ -149,23 +200,23 @@ class TestFprintdUtils(TestFprintdUtilsBase):
     def test_fprintd_list(self):
         # Rick has no fingerprints enrolled
         out, ret = self.run_utility_process('list', ['rick'])
-        self.assertRegex(out, rb'has no fingers enrolled for')
+        self.assertIn(b'has no fingers enrolled for', out)
         self.assertEqual(ret, 0)
 
         # Toto does
         out, ret = self.run_utility_process('list', ['toto'])
-        self.assertRegex(out, rb'right-little-finger')
+        self.assertIn(b'right-little-finger', out)
         self.assertEqual(ret, 0)
 
     def test_fprintd_delete(self):
         # Delete fingerprints
         out, ret = self.run_utility_process('delete', ['toto'])
-        self.assertRegex(out, rb'Fingerprints of user toto deleted')
+        self.assertIn(b'Fingerprints of user toto deleted', out)
         self.assertEqual(ret, 0)
 
         # Doesn't have fingerprints
         out, ret = self.run_utility_process('delete', ['toto'])
-        self.assertRegex(out, rb'No fingerprints to delete on')
+        self.assertIn(b'No fingerprints to delete on', out)
         self.assertEqual(ret, 0)
 
 
@@ -201,11 +252,13 @@ class TestFprintdUtilsVerify(TestFprintdUtilsBase):
         if finger:
             args += ['-f', finger]
 
-        self.process, self.output = self.start_utility_process('verify', args)
+        # The callers wait for the output they expect instead
+        self.process, self.output = self.start_utility_process('verify', args,
+            sleep=False)
         if nowait:
             return
 
-        preamble = self.output.check_line(b'Verify started!')
+        preamble = self.output.check_line(b'Verify started!', self.sleep_time)
 
         out = b''.join(preamble)
 
@@ -217,58 +270,60 @@ class TestFprintdUtilsVerify(TestFprintdUtilsBase):
                 expected_finger = self.enrolled_fingers[0]
             self.assertEqual(self.device_mock.GetSelectedFinger(), expected_finger)
 
-    def assertVerifyMatch(self, match):
-        self.output.check_line(r'Verify result: {} (done)'.format(
-            'verify-match' if match else 'verify-no-match'))
+    def assertVerifyMatch(self, match, timeout=None):
+        self.output.check_line(VERIFY_RESULT_LINES[match],
+            self.sleep_time if timeout is None else timeout)
 
     def test_fprintd_verify(self):
         self.start_verify_process()
 
-        self.device_mock.EmitVerifyStatus('verify-match', True)
-        time.sleep(self.sleep_time)
+        self.emit_verify_status('verify-match', True)
         self.assertVerifyMatch(True)
 
     def test_fprintd_verify_enrolled_fingers(self):
         for finger in self.enrolled_fingers:
-            self.start_verify_process(finger=finger)
+            with self.subTest(finger=finger):
+                self.start_verify_process(finger=finger)
 
-            self.device_mock.EmitVerifyStatus('verify-match', True)
-            time.sleep(self.sleep_time)
-            self.assertVerifyMatch(True)
+                self.emit_verify_status('verify-match', True)
+                self.assertVerifyMatch(True)
+                # Released once it exits, only then the next one can claim
+                self.assertEqual(self.wait_utility_process(self.process,
+                    self.sleep_time), 0)
 
     def test_fprintd_verify_any_finger_no_identification(self):
         self.start_verify_process(finger='any')
 
-        self.device_mock.EmitVerifyStatus('verify-match', True)
-        time.sleep(self.sleep_time)
+        self.emit_verify_status('verify-match', True)
         self.assertVerifyMatch(True)
 
     def test_fprintd_verify_any_finger_identification(self):
         self.obj_fprintd_mock.RemoveDevice(self.device_path)
         self.device_path = self.obj_fprintd_mock.AddDevice('Full powered device',
             3, 'press', True)
-        self.device_mock = self.dbus_con.get_object('net.reactivated.Fprint',
-            self.device_path)
+        self.set_device_mock(self.device_path)
         self.set_enrolled_fingers(VALID_FINGER_NAMES)
         self.start_verify_process(finger='any')
 
-        self.device_mock.EmitVerifyStatus('verify-match', True)
-        time.sleep(self.sleep_time)
+        self.emit_verify_status('verify-match', True)
         self.assertVerifyMatch(True)
 
     def test_fprintd_verify_not_enrolled_fingers(self):
-        for finger in [f for f in VALID_FINGER_NAMES if f not in self.enrolled_fingers]:
-            self.start_verify_process(finger=finger, nowait=True)
-            regex = r'Finger \'{}\' not enrolled'.format(finger)
-            self.output.check_line_re(regex, timeout=self.sleep_time)
+        enrolled = set(self.enrolled_fingers)
+        release = self.device_mock.Release
+        for finger in [f for f in VALID_FINGER_NAMES if f not in enrolled]:
+            with self.subTest(finger=finger):
+                self.start_verify_process(finger=finger, nowait=True)
+                self.output.check_line('Finger \'{}\' not enrolled'.format(finger),
+                    timeout=self.sleep_time)
 
-            self.device_mock.Release()
+                release()
 
     def test_fprintd_verify_no_enrolled_fingers(self):
         self.set_enrolled_fingers([])
         self.start_verify_process(nowait=True)
         self.output.check_line(b'No fingers enrolled for this device.', timeout=self.sleep_time)
-        self.assertEqual(self.process.poll(), 1)
+        self.assertEqual(self.wait_utility_process(self.process, self.sleep_time), 1)
 
     def test_fprintd_list_all_fingers(self):
         self.set_enrolled_fingers(VALID_FINGER_NAMES)
@@ -279,11 +334,9 @@ class TestFprintdUtilsVerify(TestFprintdUtilsBase):
             ( 'verify-match', True, 2 )
         ]
         self.device_mock.SetVerifyScript(script)
-        time.sleep(2)
 
         self.start_verify_process()
-        time.sleep(2 + self.sleep_time)
-        self.assertVerifyMatch(True)
+        self.assertVerifyMatch(True, timeout=2 + self.sleep_time)
 
     def test_fprintd_multiple_verify_fails(self):
         self.start_verify_process()
@@ -292,5 +345,7 @@ class TestFprintdUtilsVerify(TestFprintdUtilsBase):
         self.output.check_line_re(rb'Device already in use by [A-z]+', timeout=self.sleep_time)
 
 if __name__ == '__main__':
+    # meson passes a single test to each run and runs them in parallel, as
+    # every class has its own bus and mock there is nothing to serialize.
     # avoid writing to stderr
     unittest.main(testRunner=unittest.TextTestRunner(stream=sys.stdout, verbosity=2))